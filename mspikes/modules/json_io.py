@@ -102,8 +102,9 @@ class json_writer(Node):
         util.set_option_attributes(self, options, stim_chan="stimuli")
 
         try:
-            self.chanp = util.any_regex(*options['channels'])
-            self._log.info("only using channels that match '%s'", self.chanp.__doc__)
+            # the same channel names occur in every entry
+            self.chanp = util.cached_predicate(util.any_regex(*options['channels']))
+            self._log.info("only using channels that match '%s'", " | ".join(options['channels']))
         except re.error, e:
             raise ValueError("bad channel regex: %s" % e.message)
         except (KeyError, TypeError):
@@ -10,6 +10,7 @@ import numpy as nx
 from collections import namedtuple
 
 from mspikes import util
+from mspikes.util import repeatedly, read_array, to_samp_or_sec
 from mspikes.types import Node, DataBlock, tag_set
 from mspikes.modules import dispatcher
 
@@ -41,7 +42,6 @@ class _smoother(Node):
         raise NotImplementedError
 
     def send(self, chunk):
-        from mspikes.util import repeatedly
         # pass non-time series data
         if not "samples" in chunk.tags:
             Node.send(self, chunk)
@@ -49,7 +49,7 @@ class _smoother(Node):
 
         # if data is not in memory, read it once now
         if not isinstance(chunk.data, nx.ndarray):
-            chunk = chunk._replace(data=chunk.data[:])
+            chunk = chunk._replace(data=read_array(chunk.data))
         N = chunk.data.size
 
         # this implementation is a poor man's ringbuffer. A tail 'pointer'
@@ -90,7 +90,6 @@ class _smoother(Node):
         self.last_sample_t = util.to_seconds(N, chunk.ds, chunk.offset)
 
     def close(self):
-        from mspikes.util import repeatedly
         # flush the queue
         for past_chunk in repeatedly(self.init_queue.pop, 0):
             self.datafun(past_chunk)
@@ -161,7 +160,6 @@ class zscale(_smoother):
 
     def datafun(self, chunk):
         """Drop chunks that exceed the threshold"""
-        from mspikes.util import to_samp_or_sec
 
         N = chunk.data.size
         stats = self.statfun(chunk)
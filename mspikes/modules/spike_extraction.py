@@ -7,7 +7,12 @@ Created Fri Jul 12 14:05:16 2013
 """
 import numpy as nx
 
+from fractions import Fraction
+from itertools import chain
+from arf import DataTypes, is_marked_pointproc
+from mspikes import register
 from mspikes import util
+from mspikes.util import repeatedly
 from mspikes.modules import dispatcher
 from mspikes.types import Node, tag_set, DataBlock, DataError
 
@@ -48,12 +53,8 @@ class spike_extract(Node):
         self.last_chunk = None  # last chunk for spikes split across boundary
 
     def send(self, chunk):
-        from fractions import Fraction
-        from mspikes import register
+        # compiled extension, imported when first needed
         from mspikes.modules.spikes import detect_spikes
-        from mspikes.util import repeatedly
-        from itertools import chain
-        from arf import DataTypes
 
         if "scalar" in chunk.tags:
             self.last_scalar = chunk
@@ -166,12 +167,11 @@ class spike_features(Node):
     def send(self, chunk):
         """ align spikes, compute features """
         # pass data we can't use
-        from arf import is_marked_pointproc
         if not is_marked_pointproc(chunk.data) or "spike" not in chunk.data.dtype.names:
             Node.send(self, chunk)
         else:
             # need to read data now because it won't be available in close
-            self._queue.append(chunk._replace(data=chunk.data[:]))
+            self._queue.append(chunk._replace(data=util.read_array(chunk.data)))
             if chunk.ds != self._queue[0].ds:
                 self._queue.pop()
                 raise DataError("%s: sampling rate doesn't match other spikes" % chunk)
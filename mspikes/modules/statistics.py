@@ -5,6 +5,8 @@
 Copyright (C) 2013 Dan Meliza <dmeliza@gmail.com>
 Created Tue Jul 23 15:06:17 2013
 """
+from math import sqrt
+
 from mspikes import util
 from mspikes.types import Node
 
@@ -14,7 +16,10 @@ class arf_jitter(Node):
 
     def __init__(self, name):
         Node.__init__(self, name)
-        self.diffs = []
+        # running sums of the differences, so the whole series isn't stored
+        self.n = 0
+        self.total = 0
+        self.total_sq = 0
         self.prev = None
 
     def send(self, chunk):
@@ -24,18 +29,22 @@ class arf_jitter(Node):
 
         usec = dot(chunk.data['timestamp'], (1000000, 1))
         t = array((chunk.offset * 1000000, usec), dtype='int64')
-        if self.prev is None:
-            self.prev = t
-        else:
-            self.diffs.append(t - self.prev)
-            self.prev = t
+        if self.prev is not None:
+            dt = t - self.prev
+            diff = long(dt[1] - dt[0])
+            self.n += 1
+            self.total += diff
+            self.total_sq += diff * diff
+        self.prev = t
 
     def close(self):
-        from numpy import asarray
-        x = asarray(self.diffs)
-        diffs = x[:,1] - x[:,0]
+        if self.n == 0:
+            self._log.info("sample clock vs system clock: not enough entries")
+            return
+        mean = float(self.total) / self.n
+        var = float(self.total_sq * self.n - self.total * self.total) / (self.n * self.n)
         self._log.info("sample clock vs system clock: drift=%.3f us, jitter=%.3f us",
-                       diffs.mean(), diffs.std())
+                       mean, sqrt(var))
 
 
 class print_stats(Node):
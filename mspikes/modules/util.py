@@ -7,6 +7,11 @@ Created Tue Jul  9 17:00:11 2013
 
 """
 import contextlib
+from fractions import Fraction
+from arf import is_marked_pointproc, DataTypes
+from numpy import rec
+from mspikes import register
+from mspikes.util import to_seconds, to_samp_or_sec
 from mspikes.types import Node, DataBlock, tag_set
 from mspikes.modules import dispatcher
 
@@ -108,9 +113,6 @@ class splitter(Node):
         self.last_time = 0
 
     def send(self, chunk):
-        from arf import is_marked_pointproc
-        from mspikes.util import to_seconds
-
         if "events" in chunk.tags:
             # point process data is sent in one chunk
             if self.start or self.stop:
@@ -136,10 +138,27 @@ class splitter(Node):
             start, stop = time_series_offsets(chunk.offset, chunk.ds,
                                               self.start, self.stop, nframes)
 
-            for i in xrange(start, stop, self.nsamples):
-                t = to_seconds(i, chunk.ds, chunk.offset)
-                data = chunk.data[slice(i, i + self.nsamples), ...]
-                Node.send(self, chunk._replace(offset=t, data=data))
+            try:
+                ds = int(chunk.ds)
+                den = chunk.offset.denominator
+                on_grid = ds == chunk.ds and ds % den == 0
+            except (AttributeError, TypeError):
+                on_grid = False
+            if on_grid:
+                # the chunk starts on its sample grid, so the offsets can be
+                # counted in integer samples, with one Fraction per output chunk
+                n = chunk.offset.numerator * (ds // den)
+                for i in xrange(start, stop, self.nsamples):
+                    data = chunk.data[slice(i, i + self.nsamples), ...]
+                    Node.send(self, chunk._replace(offset=Fraction(n + i, ds), data=data))
+            else:
+                # offsets advance by a constant step, so only compute them once
+                t = to_seconds(start, chunk.ds, chunk.offset)
+                dt = to_seconds(self.nsamples, chunk.ds)
+                for i in xrange(start, stop, self.nsamples):
+                    data = chunk.data[slice(i, i + self.nsamples), ...]
+                    Node.send(self, chunk._replace(offset=t, data=data))
+                    t += dt
 
             self.last_time = to_seconds(nframes, chunk.ds, chunk.offset)
 
@@ -218,10 +237,6 @@ class entry_excluder(Node):
         self.entry_count = 0
 
     def send(self, chunk):
-        from mspikes.util import to_samp_or_sec, to_seconds
-        from mspikes import register
-        from arf import DataTypes
-        from numpy import rec
         if "structure" in chunk.tags:
             # structure tag is always passed on first, which can be used downstream
             Node.send(self, chunk)
@@ -262,8 +277,6 @@ def timeseries_reader(array, ds, chunk_size, gap=0, id='', tags=tag_set("samples
 
     """Read chunks from a 1d time series array"""
     from numpy import array_split
-    from mspikes.types import DataBlock
-    from mspikes.util import to_seconds
 
     assert array.ndim == 1
     t = 0
@@ -275,8 +288,6 @@ def timeseries_reader(array, ds, chunk_size, gap=0, id='', tags=tag_set("samples
 def pointproc_reader(array, ds, chunk_size, gap=0, id='', tags=tag_set("events")):
     """Read chunks from a 1d point process (unmarked) array"""
     from numpy import array_split
-    from mspikes.types import DataBlock
-    from mspikes.util import to_seconds
 
     assert array.ndim == 1
     if array.shape[0] < chunk_size:
@@ -294,8 +305,14 @@ def time_series_offsets(dset_time, dset_ds, start_time, stop_time, nframes):
     array, restricted between start_time and stop_time (in seconds).
 
     """
-    start_idx = max(0, (start_time - dset_time) * dset_ds) if start_time else 0
-    stop_idx = min(nframes, (stop_time - dset_time) * dset_ds) if stop_time else nframes
+    if not (start_time or stop_time):
+        return 0, nframes
+    if dset_ds is None:
+        raise TypeError("time series must have a sampling rate")
+    # work in integer sample counts to avoid float drift in long recordings
+    dset_idx = to_samp_or_sec(dset_time, dset_ds)
+    start_idx = max(0, to_samp_or_sec(start_time, dset_ds) - dset_idx) if start_time else 0
+    stop_idx = min(nframes, to_samp_or_sec(stop_time, dset_ds) - dset_idx) if stop_time else nframes
 
     return int(start_idx), int(stop_idx)
 
@@ -5,7 +5,24 @@
 Copyright (C) 2013 Dan Meliza <dmeliza@gmail.com>
 Created Thu Jun 20 17:18:40 2013
 """
+import re
 from collections import defaultdict
+from fractions import Fraction, gcd
+
+from numpy import asarray, empty, ndarray, searchsorted
+
+# used by natsorted, which is called once per item being sorted
+_split_digits = re.compile(r"([0-9]+)").split
+# natsorted keys by name. Dataset names repeat in every entry, so each one only
+# has to be split once.
+_natsort_keys = {}
+# compiled alternations from any_regex, keyed by the tuple of patterns. The re
+# module's own cache is small and shared with the rest of the program.
+_regex_cache = {}
+# constructs that change meaning when a pattern is joined into an alternation
+# with others: inline flags (which apply to the whole regex in python 2), group
+# names, and backreferences
+_not_joinable = re.compile(r"\(\?[iLmsux]|\(\?P|\\[1-9]").search
 
 
 def true_p(*args):
@@ -24,13 +41,80 @@ def any_predicate(*ps):
 
 
 def any_regex(*regexes):
-    """Return closure that tests for match against any of the arguments"""
-    import re
-    rx = [re.compile(regex).match for regex in regexes]
-    def multimatch(x):
-        return any(p(x) for p in rx)
-    multimatch.__doc__ = " | ".join(regexes)
-    return multimatch
+    """Return function that tests for match against any of the arguments.
+
+    The patterns are combined into a single alternation and compiled once, so
+    each test is one call to the regex engine. Patterns with inline flags,
+    named groups, or backreferences are compiled and tested separately, as
+    joining them would change their meaning. If every pattern starts with
+    some literal text, names that don't start with any of it are rejected
+    without calling the regex engine, and if the patterns are entirely literal
+    the regex isn't used at all. If there are no arguments, the function
+    matches nothing.
+
+    """
+    if not regexes:
+        return lambda x: False
+    try:
+        return _regex_cache[regexes]
+    except KeyError:
+        if any(_not_joinable(regex) for regex in regexes):
+            matches = [re.compile(regex).match for regex in regexes]
+            match = lambda x: any(m(x) is not None for m in matches)
+        else:
+            match = re.compile("|".join("(?:%s)" % regex for regex in regexes)).match
+        prefixes = [_literal_prefix(regex) for regex in regexes]
+        starts = tuple(prefix for prefix, exact in prefixes)
+        if not all(starts):
+            p = match
+        elif all(exact for prefix, exact in prefixes):
+            p = lambda x: x.startswith(starts)
+        else:
+            p = lambda x: x.startswith(starts) and bool(match(x))
+        _regex_cache[regexes] = p
+        return p
+
+
+def _literal_prefix(regex):
+    """Returns (prefix, exact), where prefix is the literal text regex must start with
+
+    exact is True if the whole of regex is literal text. Patterns with flags
+    and non-ASCII characters are not analyzed.
+
+    """
+    import sre_parse
+    from sre_constants import LITERAL
+    parsed = sre_parse.parse(regex)
+    if parsed.pattern.flags & ~(re.UNICODE | re.LOCALE):
+        return '', False
+    prefix = []
+    for op, av in parsed:
+        if op is not LITERAL or av >= 128:
+            return ''.join(prefix), False
+        prefix.append(chr(av))
+    return ''.join(prefix), True
+
+
+class _predicate_cache(dict):
+    """Maps arguments to the results of a predicate, calling it on a miss"""
+
+    def __init__(self, p):
+        dict.__init__(self)
+        self.p = p
+
+    def __missing__(self, key):
+        val = self[key] = bool(self.p(key))
+        return val
+
+
+def cached_predicate(p):
+    """Return a version of predicate p that remembers its result for each argument.
+
+    Useful when p is called repeatedly with the same (hashable) arguments, like
+    the dataset names in each entry of a file. A hit is a single dict lookup.
+
+    """
+    return _predicate_cache(p).__getitem__
 
 
 def compose(f1, f2, unpack=False):
@@ -84,11 +168,22 @@ def set_option_attributes(obj, opts, **attrs):
 
 def to_seconds(samples, sampling_rate=None, offset=None):
     """Converts samples / sampling_rate to canonical form, optionally adding offset"""
-    from fractions import Fraction
     if sampling_rate is None:
         val = float(samples)
     else:
-        val = Fraction(int(samples), int(sampling_rate))
+        sampling_rate = int(sampling_rate)
+        # when offset is rational (the usual case for chunk offsets), the sum
+        # is a single Fraction over a common denominator instead of two plus an
+        # addition. On the sample grid, the denominator is the sampling rate.
+        den = getattr(offset, 'denominator', None)
+        if den is not None:
+            if sampling_rate % den == 0:
+                return Fraction(offset.numerator * (sampling_rate // den) + int(samples),
+                                sampling_rate)
+            lcm = sampling_rate // gcd(sampling_rate, den) * den
+            return Fraction(offset.numerator * (lcm // den) +
+                            int(samples) * (lcm // sampling_rate), lcm)
+        val = Fraction(int(samples), sampling_rate)
     if offset is not None:
         return offset + val
     else:
@@ -101,10 +196,36 @@ def to_samp_or_sec(seconds, sampling_rate):
     If sampling_rate is None, returns seconds as a floating point.
 
     """
-    if sampling_rate is not None:
-        return long(round(seconds * float(sampling_rate)))
-    else:
+    if sampling_rate is None:
         return float(seconds)
+    try:
+        q, r = divmod(sampling_rate, seconds.denominator)
+    except AttributeError:
+        pass
+    else:
+        # rational times on the sample grid convert exactly without floats
+        if r == 0:
+            return long(seconds.numerator * q)
+    return long(round(seconds * float(sampling_rate)))
+
+
+def samples_between(start, stop, sampling_rate):
+    """Returns to_samp_or_sec(stop - start, sampling_rate)
+
+    If both times are on the sample grid, the difference is taken in integer
+    samples without building an intermediate Fraction.
+
+    """
+    if sampling_rate is not None:
+        try:
+            q1, r1 = divmod(sampling_rate, stop.denominator)
+            q0, r0 = divmod(sampling_rate, start.denominator)
+        except AttributeError:
+            pass
+        else:
+            if r1 == 0 and r0 == 0:
+                return long(stop.numerator * q1 - start.numerator * q0)
+    return to_samp_or_sec(stop - start, sampling_rate)
 
 
 def event_offset(events, offset):
@@ -117,10 +238,9 @@ def event_offset(events, offset):
     incremented by offset.
 
     """
-    from numpy import asarray
     if hasattr(events, 'dtype') and events.dtype.fields is not None:
-        evts = events[:]
-        assert evts is not events, "failed to copy input argument"
+        # slicing an array gives a view, which would modify the argument
+        evts = events.copy() if isinstance(events, ndarray) else events[:]
         evts['start'] += offset
     else:
         evts = asarray(events) + offset
@@ -129,17 +249,35 @@ def event_offset(events, offset):
 
 def event_times(events):
     """Returns event times from a marked or unmarked point process time series"""
-    from numpy import asarray
     if hasattr(events, 'dtype') and events.dtype.fields is not None:
         return events['start']
     else:
         return asarray(events)
 
 
+def read_array(data):
+    """Returns data as an in-memory array, reading it if it's an h5py dataset.
+
+    Datasets are read with read_direct into a preallocated array, which avoids
+    the intermediate copy made by slicing.
+
+    """
+    if isinstance(data, ndarray):
+        return data
+    if not hasattr(data, 'read_direct') or data.size == 0:
+        return data[:]
+    out = empty(data.shape, data.dtype)
+    data.read_direct(out)
+    return out
+
+
 def natsorted(key):
     """ key function for natural sorting. usage: sorted(seq, key=natsorted) """
-    import re
-    return map(lambda t: int(t) if t.isdigit() else t, re.split(r"([0-9]+)",key))
+    try:
+        return _natsort_keys[key]
+    except KeyError:
+        k = _natsort_keys[key] = [int(t) if t.isdigit() else t for t in _split_digits(key)]
+        return k
 
 
 def cutarray(x, cuts):
@@ -153,11 +291,10 @@ def cutarray(x, cuts):
     Preconditions: both arguments must be sorted
 
     """
-    from bisect import bisect_left
     cix = -1
     pos = 0
-    for cut in cuts:
-        idx = bisect_left(x, cut, pos)
+    # all the cuts are located in a single call
+    for idx in searchsorted(x, cuts, side='left').tolist():
         if idx > pos:
             yield (cix, slice(pos, idx))
             pos = idx
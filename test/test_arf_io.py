@@ -82,6 +82,227 @@ def test_entry_iteration():
     dset_times = [d.offset for d in r]
     assert_sequence_equal(dset_times, [Fraction(str(t)) for t in expected_times])
 
+    # entries were created in temporal order, so sorting can be skipped
+    r.skip_sort = True
+    dset_times = [d.offset for d in r]
+    assert_sequence_equal(dset_times, [Fraction(str(t)) for t in expected_times])
+
+    # selecting entries doesn't change the timebase
+    r.entryp = arf_io.util.any_regex("entry-s")
+    dset_times = [d.offset for d in r]
+    assert_sequence_equal(dset_times, [Fraction(str(t)) for t in expected_times[4:]])
+
+
+def test_sorted_entries():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    for name, t in (("b", 20.), ("a", 10.), ("c", 30.), ("d", (20, 500))):
+        arf.create_entry(fp, name, t)
+    fp.create_group("untimed")
+    fp.create_dataset("not_an_entry", data=[1, 2, 3])
+
+    assert_sequence_equal([e.name for e in arf_io.sorted_entries(fp)],
+                          ["/untimed", "/a", "/b", "/d", "/c"])
+    assert_sequence_equal([e.name for e in arf_io.sorted_entries(fp, by_creation=True)],
+                          ["/b", "/a", "/c", "/d", "/untimed"])
+    # entries created in time order
+    fp2 = get_scratch_file("tmp", driver="core", backing_store=False)
+    for name, t in (("b", 10.), ("a", 20.), ("c", (20, 1))):
+        arf.create_entry(fp2, name, t)
+    assert_sequence_equal([e.name for e in arf_io.sorted_entries(fp2)], ["/b", "/a", "/c"])
+    # scalar float timestamps in the same second
+    fp3 = get_scratch_file("tmp", driver="core", backing_store=False)
+    fp3.create_group("x").attrs["timestamp"] = 5.7
+    fp3.create_group("y").attrs["timestamp"] = 5.2
+    assert_sequence_equal([e.name for e in arf_io.sorted_entries(fp3)], ["/y", "/x"])
+
+    entries, stamps = arf_io.sorted_entries(fp, timestamps=True)
+    assert_true(stamps[0] is None)
+    assert_sequence_equal([tuple(t) for t in stamps[1:]],
+                          [(10, 0), (20, 0), (20, 500), (30, 0)])
+    to_seconds = arf_io.entry_offset_calculator(use_timestamp=True)
+    assert_sequence_equal(to_seconds.offsets(entries, stamps),
+                          arf_io.entry_offset_calculator(use_timestamp=True).offsets(entries))
+
+
+def test_read_attribute():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    e = arf.create_entry(fp, "entry", 10., sample_count=nx.uint32(100), sampling_rate=1000)
+    for name in ("timestamp", "sample_count", "sampling_rate"):
+        value = arf_io.read_attribute(e.id, name)
+        assert_equal(type(value), type(e.attrs[name]))
+        assert_array_equal(value, e.attrs[name])
+    with assert_raises(KeyError):
+        arf_io.read_attribute(e.id, "jack_frame")
+
+
+def test_chunk_cache():
+    import os
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix=".arf")
+    os.close(fd)
+    os.remove(path)
+    try:
+        arf.open_file(path, "a").close()
+        writer = arf_io.arf_writer('writer', path, dry_run=True, cache_size=16)
+        mdc, nslots, nbytes, w0 = writer.file.id.get_access_plist().get_cache()
+        assert_equal(nbytes, 16 * 1024 * 1024)
+        assert_equal(w0, 1.0)
+        writer.file.close()
+    finally:
+        os.remove(path)
+    # new in-memory files are created by arf
+    writer = arf_io.arf_writer('writer', "scratch_cache", dry_run=True, cache_size=16)
+    assert_true("arf_version" in writer.file.attrs)
+
+
+def test_metadata_cache():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    arf_io.set_metadata_cache(fp, 16 << 20)
+    assert_equal(fp.id.get_mdc_config().initial_size, 16 << 20)
+
+
+def test_dset_tags():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    pcm = arf.create_dataset(fp, "pcm", nx.zeros(10), units="mV", sampling_rate=1000)
+    spikes = arf.create_dataset(fp, "spikes", random_spikes(10, 1.0, 1000),
+                                units=("samples", ""), sampling_rate=1000)
+    old = fp.create_dataset("old", data=random_spikes(10, 1.0, 1000))
+    old.attrs["units"] = "samples"
+    assert_true("samples" in arf_io.dset_tags(pcm))
+    assert_true("events" in arf_io.dset_tags(spikes))
+    assert_true("events" in arf_io.dset_tags(old, dict(old.attrs)))
+
+
+def test_timestamps_to_float():
+    stamps = nx.array([[10, 900000], [11, 100000], [1370000000, 123456]])
+    assert_sequence_equal(arf_io.timestamps_to_float(stamps).tolist(),
+                          [arf.timestamp_to_float(t) for t in stamps])
+
+
+def test_corrected_counter():
+    frames = nx.array([4294967000, 4294967295, 100, 1000], dtype=nx.uint32)
+    assert_array_equal(arf_io.corrected_counter(frames), [0, 295, 396, 1296])
+
+    stamps = nx.array([[10, 900000], [11, 100000], [12, 0]])
+    assert_array_equal(arf_io.corrected_counter(stamps), [[0, 0], [1, -800000], [2, -900000]])
+
+
+def test_entry_offsets():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    srate = 1000
+    frames = (4294967000, 4294967295, 100)
+    for i, frame in enumerate(frames):
+        arf.create_entry(fp, "entry_%d" % i, float(i), jack_frame=nx.uint32(frame),
+                         jack_sampling_rate=srate)
+    entries = arf_io.sorted_entries(fp)
+
+    offsets = arf_io.entry_offset_calculator().offsets(entries)
+    assert_sequence_equal(offsets, [(Fraction(t, srate), srate) for t in (0, 295, 396)])
+    to_seconds = arf_io.entry_offset_calculator()
+    assert_sequence_equal(offsets, [to_seconds(e) for e in entries])
+
+    # older jill files only store the sampling rate on the datasets
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    for i, frame in enumerate(frames):
+        e = arf.create_entry(fp, "entry_%d" % i, float(i), jack_frame=nx.uint32(frame))
+        arf.create_dataset(e, "pcm", nx.zeros(10), sampling_rate=srate)
+    offsets = arf_io.entry_offset_calculator().offsets(arf_io.sorted_entries(fp))
+    assert_sequence_equal(offsets, [(Fraction(t, srate), srate) for t in (0, 295, 396)])
+
+
+def test_matches_entry():
+    from uuid import uuid4
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    e = arf.create_entry(fp, "entry", 10.)
+    attrs = dict(e.attrs)
+    assert_true(arf_io.matches_entry(DataBlock(e.name, 0, None, attrs, ()), e))
+    attrs['timestamp'] = (5, 0)
+    assert_true(arf_io.matches_entry(DataBlock(e.name, 0, None, attrs, ()), e))
+    attrs['uuid'] = str(uuid4())
+    assert_false(arf_io.matches_entry(DataBlock(e.name, 0, None, attrs, ()), e))
+    # pre-2.0 entries are matched by timestamp
+    del attrs['uuid']
+    assert_false(arf_io.matches_entry(DataBlock(e.name, 0, None, attrs, ()), e))
+    attrs['timestamp'] = (10, 0)
+    assert_true(arf_io.matches_entry(DataBlock(e.name, 0, None, attrs, ()), e))
+    attrs['timestamp'] = nx.array([10, 0], dtype='i4')
+    assert_true(arf_io.matches_entry(DataBlock(e.name, 0, None, attrs, ()), e))
+
+
+def test_time_window():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    for i in range(5):
+        arf.create_entry(fp, "entry_%d" % i, float(i))
+
+    r = arf_io.arf_reader('reader', fp, start=1.0, stop=3.0)
+    assert_sequence_equal([c.offset for c in r], [1.0, 2.0, 3.0])
+
+    # out of order entries
+    arf.create_entry(fp, "entry_5", 2.5)
+    r.skip_sort = True
+    assert_sequence_equal([c.offset for c in r], [1.0, 2.0, 3.0, 2.5])
+
+
+def test_entry_subgroups():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    e = arf.create_entry(fp, "entry", 0.)
+    arf.create_dataset(e, "pcm", nx.zeros(10), sampling_rate=1000)
+    e.create_group("notes")
+    arf.create_dataset(e, "empty", nx.zeros(0), sampling_rate=1000)
+    r = arf_io.arf_reader('reader', fp)
+    assert_sequence_equal([c.id for c in r], ["/entry", "pcm"])
+
+
+def test_channel_selector():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    e = arf.create_entry(fp, "entry", 0.)
+    for name in ("pcm_000", "pcm_001", "spikes"):
+        arf.create_dataset(e, name, nx.zeros(10), sampling_rate=1000)
+    r = arf_io.arf_reader('reader', fp, channels=["pcm_00[1]", "spk"])
+    assert_sequence_equal([c.id for c in r], ["/entry", "pcm_001"])
+    # readers with the same selector share the cached results
+    r2 = arf_io.arf_reader('reader', fp, channels=["pcm_00[1]", "spk"])
+    assert_true(r2.chanp is r.chanp)
+
+
+def test_skip_xruns():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    arf.create_entry(fp, "entry_0", 0.)
+    arf.create_entry(fp, "entry_1", 1., jill_error="xrun")
+
+    r = arf_io.arf_reader('reader', fp)
+    assert_sequence_equal([c.id for c in r], ["/entry_0"])
+    r.ignore_xruns = True
+    assert_sequence_equal([c.id for c in r], ["/entry_0", "/entry_1"])
+
+
+def test_prefetch():
+    fp = get_scratch_file("tmp", driver="core", backing_store=False)
+    srate = 1000
+    for i in range(3):
+        e = arf.create_entry(fp, "entry_%d" % i, float(i), sample_count=i * srate)
+        arf.create_dataset(e, "pcm", nx.random.randn(srate), sampling_rate=srate)
+
+    r = arf_io.arf_reader('reader', fp, prefetch=True)
+    chunks = [c for c in r if "samples" in c.tags]
+    assert_equal(len(chunks), 3)
+    for i, chunk in enumerate(chunks):
+        assert_true(isinstance(chunk.data, nx.ndarray))
+        assert_array_equal(chunk.data, fp["entry_%d" % i]["pcm"])
+
+    r.prefetch_depth = 2
+    chunks = [c for c in r if "samples" in c.tags]
+    assert_equal(len(chunks), 3)
+    assert_array_equal(chunks[2].data, fp["entry_2"]["pcm"])
+    # abandoning the iterator stops the reading thread
+    it = iter(r)
+    next(it)
+    it.close()
+    # errors in the reading thread are raised in the consumer
+    fp["entry_2"].create_dataset("scalar", data=1.0)
+    with assert_raises(IndexError):
+        list(r)
+
 
 def compare_entries(name, src, tgt):
     assert_true(name in tgt)
@@ -136,6 +357,7 @@ def mirror_file(sampled):
                 queue.append(chunk)
         for chunk in queue:
             chain.send(chunk)
+    writer.close()
 
     for entry in src:
         compare_entries(entry, src, tgt)
@@ -146,6 +368,7 @@ def mirror_file(sampled):
         if "structure" not in chunk.tags:
             chunk = chunk._replace(id=chunk.id + "_new")
         writer.send(chunk)
+    writer.close()
     for entry in src:
         compare_entries(entry, src, tgt)
 
@@ -155,6 +378,125 @@ def test_file_mirroring():
         yield mirror_file, sampled
 
 
+def test_chunk_shape():
+    assert_equal(arf_io.chunk_shape((100,), nx.dtype('i2'), 1024), (500,))
+    assert_equal(arf_io.chunk_shape((1000,), nx.dtype('i2'), 1024), (512,))
+    assert_equal(arf_io.chunk_shape((0,), nx.dtype('i2'), 1024), (512,))
+    assert_equal(arf_io.chunk_shape((10, 4), nx.dtype('d'), 1024), (30, 4))
+    assert_equal(arf_io.chunk_shape((100, 4), nx.dtype('d'), 1024), (32, 4))
+    assert_equal(arf_io.chunk_shape((100, 4), nx.dtype('d'), 16), (1, 4))
+
+
+def test_writer_codec():
+    srate = 1000
+    for codec, filter in (("gzip", "gzip"), ("lzf", "lzf"), ("none", None)):
+        tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+        arf.create_entry(tgt, "entry", timestamp=0, sample_count=0, sampling_rate=srate)
+        writer = arf_io.arf_writer('writer', tgt, codec=codec)
+        writer.send(DataBlock("pcm", 0, srate, nx.random.randn(srate), ("samples",)))
+        assert_equal(tgt["entry"]["pcm"].compression, filter)
+
+    # by default sampled data uses lzf and events gzip
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    arf.create_entry(tgt, "entry", timestamp=0, sample_count=0, sampling_rate=srate)
+    writer = arf_io.arf_writer('writer', tgt)
+    writer.send(DataBlock("pcm", 0, srate, nx.random.randn(srate), ("samples",)))
+    writer.send(DataBlock("spikes", 0, srate, random_spikes(10, 1.0, srate), ("events",)))
+    assert_equal(tgt["entry"]["pcm"].compression, "lzf")
+    assert_equal(tgt["entry"]["spikes"].compression, "gzip")
+
+    # unless a gzip compression level is given
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    arf.create_entry(tgt, "entry", timestamp=0, sample_count=0, sampling_rate=srate)
+    writer = arf_io.arf_writer('writer', tgt, compress=0)
+    writer.send(DataBlock("pcm", 0, srate, nx.random.randn(srate), ("samples",)))
+    assert_equal(tgt["entry"]["pcm"].compression, "gzip")
+    assert_equal(tgt["entry"]["pcm"].compression_opts, 0)
+
+
+def test_plugin_codecs():
+    # these need hdf5plugin, which may not be installed
+    for codec in ("bitshuffle", "blosc"):
+        try:
+            opts = arf_io.compression_options(codec)
+        except arf_io.ArfError:
+            continue
+        tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+        data = nx.random.randn(1000)
+        assert_array_equal(tgt.create_dataset("pcm", data=data, chunks=(100,), **opts), data)
+
+
+def test_writer_uncompressed_size():
+    # uncompressed chunks aren't much bigger than the data in short datasets
+    srate = 1000
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    writer = arf_io.arf_writer('writer', tgt, codec="none")
+    for i in range(20):
+        writer.send(DataBlock("entry_%02d" % i, Fraction(i * 3), srate, {}, ("structure",)))
+        writer.send(DataBlock("pcm", Fraction(i * 3), srate,
+                              nx.zeros(2 * srate, dtype='i2'), ("samples",)))
+    writer.close()
+    tgt.flush()
+    assert_equal(tgt["entry_00"]["pcm"].chunks, (2 * srate,))
+    assert_true(tgt.id.get_filesize() < 20 * 2 * srate * 2 * 4)
+
+
+def test_writer_buffer():
+    srate = 1000
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    arf.create_entry(tgt, "entry", timestamp=0, sample_count=0, sampling_rate=srate)
+    data = nx.random.randn(srate)
+    writer = arf_io.arf_writer('writer', tgt)
+    for i in range(0, srate, 100):
+        writer.send(DataBlock("pcm", Fraction(i, srate), srate, data[i:i + 100], ("samples",)))
+    # buffered rows count toward the gap check
+    with assert_raises(arf_io.ArfError):
+        writer.send(DataBlock("pcm", 2, srate, data, ("samples",)))
+    writer.close()
+    assert_array_equal(tgt["entry"]["pcm"], data)
+
+    # buffered data is written if processing stops with an error
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    arf.create_entry(tgt, "entry", timestamp=0, sample_count=0, sampling_rate=srate)
+    writer = arf_io.arf_writer('writer', tgt)
+    writer.send(DataBlock("pcm", 0, srate, data[:100], ("samples",)))
+    writer.throw(KeyboardInterrupt())
+    assert_array_equal(tgt["entry"]["pcm"], data[:100])
+
+
+def test_writer_contiguous():
+    srate = 1000
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    arf.create_entry(tgt, "entry", timestamp=0, sample_count=0, sampling_rate=srate)
+    data = nx.random.randn(srate)
+    writer = arf_io.arf_writer('writer', tgt, contiguous=True)
+    for i in range(0, srate, 100):
+        writer.send(DataBlock("pcm", Fraction(i, srate), srate, data[i:i + 100], ("samples",)))
+    with assert_raises(arf_io.ArfError):
+        writer.send(DataBlock("pcm", Fraction(1, 1), srate // 2, data, ("samples",)))
+    assert_false("pcm" in tgt["entry"])
+    writer.close()
+    dset = tgt["entry"]["pcm"]
+    assert_equal(dset.chunks, None)
+    assert_equal(dset.compression, None)
+    assert_equal(dset.attrs['sampling_rate'], srate)
+    assert_array_equal(dset, data)
+
+
+def test_writer_contiguous_from_dataset():
+    srate = 1000
+    src = get_scratch_file("src", driver="core", backing_store=False)
+    pcm = src.create_dataset("pcm", data=nx.random.randn(srate), chunks=(100,))
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    arf.create_entry(tgt, "entry", timestamp=0, sample_count=0, sampling_rate=srate)
+    writer = arf_io.arf_writer('writer', tgt, contiguous=True)
+    writer.send(DataBlock("pcm", 0, srate, pcm, ("samples",)))
+    writer.close()
+    dset = tgt["entry"]["pcm"]
+    assert_equal(dset.chunks, None)
+    assert_array_equal(dset, pcm)
+
+
 def test_arf_writer_pproc():
     """test writing point process data
 
@@ -185,6 +527,69 @@ def test_arf_writer_pproc():
     assert_true(all(d1['start'] < (cut * srate)))
 
 
+def test_arf_writer_pproc_late():
+    """test writing point process data that falls after the first entries"""
+    srate = 1000
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    spikes = random_spikes(50, 1.0, srate)
+    for i in range(4):
+        arf.create_entry(tgt, "entry_%d" % i, timestamp=i)
+
+    writer = arf_io.arf_writer('writer', tgt)
+    writer.send(DataBlock("spikes", 2, srate, spikes, ("events",)))
+
+    assert_true("spikes" not in tgt['entry_1'])
+    assert_array_equal(tgt['entry_2']['spikes']['start'], spikes['start'])
+    assert_equal(tgt['entry_2']['spikes'].chunks,
+                 arf_io.chunk_shape((0,), spikes.dtype, 64 * 1024))
+
+
+
+def test_writer_infers_timestamp():
+    srate = 1000
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    arf.create_entry(tgt, "entry_0", timestamp=100, sample_count=0, sampling_rate=srate)
+    writer = arf_io.arf_writer('writer', tgt)
+    writer.send(DataBlock("entry_1", 2, srate, {}, ("structure",)))
+    writer.send(DataBlock("entry_2", 1, srate, {}, ("structure",)))
+    assert_equal(arf.timestamp_to_float(tgt["entry_1"].attrs["timestamp"]), 102)
+    assert_equal(arf.timestamp_to_float(tgt["entry_2"].attrs["timestamp"]), 101)
+    assert_sequence_equal([writer._entry_name(i) for i in range(3)],
+                          ["/entry_0", "/entry_2", "/entry_1"])
+
+
+def test_writer_existing_dataset():
+    srate = 1000
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    e = arf.create_entry(tgt, "entry", timestamp=0, sample_count=0, sampling_rate=srate)
+    arf.create_dataset(e, "spikes", nx.arange(5), units="samples", sampling_rate=srate,
+                       maxshape=(None,))
+    spikes = nx.arange(10, 20)
+    writer = arf_io.arf_writer('writer', tgt)
+    with assert_raises(arf_io.ArfError):
+        writer.send(DataBlock("spikes", 0, srate, spikes, ("events",)))
+    writer = arf_io.arf_writer('writer', tgt, overwrite=True)
+    writer.send(DataBlock("spikes", 0, srate, spikes, ("events",)))
+    writer.send(DataBlock("spikes", 0, srate, spikes + 10, ("events",)))
+    assert_array_equal(tgt["entry"]["spikes"], nx.arange(10, 30))
+
+
+def test_arf_writer_pproc_new_entry():
+    """test writing point process data after an entry has been added"""
+    srate = 1000
+    tgt = get_scratch_file("tgt", driver="core", backing_store=False)
+    spikes = random_spikes(50, 1.0, srate)
+    arf.create_entry(tgt, "entry_0", timestamp=0, sample_count=0, sampling_rate=srate)
+
+    writer = arf_io.arf_writer('writer', tgt)
+    writer.send(DataBlock("spikes", 0, srate, spikes, ("events",)))
+    writer.send(DataBlock("entry_1", 2, srate, {"timestamp": (2, 0)}, ("structure",)))
+    assert_array_equal(writer._entry_cuts(srate), [0, 2 * srate])
+    writer.send(DataBlock("spikes", 2, srate, spikes, ("events",)))
+
+    assert_array_equal(tgt['entry_0']['spikes']['start'], spikes['start'])
+    assert_array_equal(tgt['entry_1']['spikes']['start'], spikes['start'])
+
 # no longer supported - this should be a very infrequent use case, and it's not
 # worht the complexity right now
 @SkipTest
@@ -36,6 +36,7 @@ def test_rand_samples():
 
 
 def test_time_series_offset():
+    from fractions import Fraction
     from mspikes.modules import util
 
     f = util.time_series_offsets
@@ -44,6 +45,8 @@ def test_time_series_offset():
     assert_equal(f(20, 1, 20, 80, 100), (0, 60))
 
     assert_equal(f(0, 10, 20, 80, 1000), (200, 800))
+    # offsets are calculated in integer samples
+    assert_equal(f(Fraction(1, 3), 3, 2.0, None, 100), (5, 100))
 
     with assert_raises(TypeError):
         f(0, None, 20, 80, 5)
@@ -67,6 +70,20 @@ def test_splitter():
 
     assert_true(array_equal(concatenate(x), data.data))
 
+    # offsets are exact whether or not the chunk starts on the sample grid
+    from fractions import Fraction
+    for offset in (Fraction(3, 2), Fraction(1, 3)):
+        t = []
+        with util.chain_modules(splitter, util.visitor(lambda c: t.append(c.offset))) as chain:
+            chain.send(data._replace(offset=offset, ds=1000))
+        assert_sequence_equal(t, [offset + Fraction(i * N, 1000) for i in range(10)])
+    # sampling rates read from files are often floats
+    from numpy import float64
+    t = []
+    with util.chain_modules(splitter, util.visitor(lambda c: t.append(c.offset))) as chain:
+        chain.send(data._replace(offset=Fraction(1, 2), ds=float64(1000.0)))
+    assert_sequence_equal(t, [Fraction(1, 2) + Fraction(i * N, 1000) for i in range(10)])
+
 
 
 
@@ -41,6 +41,55 @@ def test_pairiter():
                           [(1, 2), (2, 3), (3, 4), (4, 5)])
 
 
+def test_any_regex():
+    p = util.any_regex("pcm_000$", "(?!pcm)")
+    assert_true(p("pcm_000"))
+    assert_true(p("spikes"))
+    assert_false(p("pcm_0001"))
+    assert_false(p("pcm_001"))
+    assert_false(util.any_regex()("pcm_000"))
+    assert_true(util.any_regex("pcm_000$", "(?!pcm)") is p)
+    # literal prefixes
+    p = util.any_regex("pcm_00[01]$", "spk")
+    assert_true(p("pcm_001"))
+    assert_true(p("spk_1"))
+    assert_false(p("pcm_002"))
+    assert_false(p("pcm_0011"))
+    assert_false(p("xpcm_001"))
+    p = util.any_regex("pcm", "spk")
+    assert_true(p("pcm_000"))
+    assert_true(p(u"spk"))
+    assert_false(p("spikes"))
+    p = util.any_regex("PCM", "(?i)spk")
+    assert_false(p("pcm"))
+    assert_true(p("SPK"))
+    p = util.any_regex("(a)\\1", "(b)\\1")
+    assert_true(p("aa"))
+    assert_true(p("bb"))
+    assert_false(p("ba"))
+    p = util.any_regex("(?P<ch>pcm)_0", "(?P<ch>spk)_1")
+    assert_true(p("pcm_0"))
+    assert_true(p("spk_1"))
+    assert_false(p("spk_0"))
+
+
+def test_cached_predicate():
+    calls = []
+
+    def p(x):
+        calls.append(x)
+        return x > 1
+    cp = util.cached_predicate(p)
+    assert_sequence_equal(filter(cp, [1, 2, 3, 1, 2, 3]), [2, 3, 2, 3])
+    assert_sequence_equal(calls, [1, 2, 3])
+
+
+def test_natsorted():
+    assert_sequence_equal(sorted(["pcm_10", "pcm_9", "spikes", "pcm_100"], key=util.natsorted),
+                          ["pcm_9", "pcm_10", "pcm_100", "spikes"])
+    assert_true(util.natsorted("pcm_10") is util.natsorted("pcm_10"))
+
+
 def test_to_samp_or_sec():
     from fractions import Fraction
 
@@ -49,6 +98,32 @@ def test_to_samp_or_sec():
     assert_equal(util.to_samp_or_sec(1.0005, None), 1.0005)
     assert_equal(util.to_samp_or_sec(Fraction(10005, 10000), 1000), 1001)
     assert_equal(util.to_samp_or_sec(Fraction(10005, 10000), None), 1.0005)
+    assert_equal(util.to_samp_or_sec(Fraction(3, 4), 1000), 750)
+    assert_equal(util.to_samp_or_sec(Fraction(2 ** 60 + 1, 1000), 1000), 2 ** 60 + 1)
+    assert_equal(util.to_samp_or_sec(2, 1000), 2000)
+
+
+def test_to_seconds():
+    from fractions import Fraction
+
+    assert_equal(util.to_seconds(500, 1000), Fraction(1, 2))
+    assert_equal(util.to_seconds(500, None), 500.0)
+    assert_equal(util.to_seconds(500, 1000, Fraction(3, 4)), Fraction(5, 4))
+    assert_equal(util.to_seconds(1, 1000, Fraction(1, 3)), Fraction(1, 3) + Fraction(1, 1000))
+    assert_equal(util.to_seconds(3, 30000, Fraction(7, 20000)), Fraction(7, 20000) + Fraction(1, 10000))
+    assert_equal(util.to_seconds(500, 1000, 2), Fraction(5, 2))
+    assert_equal(util.to_seconds(500, 1000, 0.25), 0.75)
+
+
+def test_samples_between():
+    from fractions import Fraction
+
+    assert_equal(util.samples_between(Fraction(1, 2), Fraction(3, 4), 1000), 250)
+    assert_equal(util.samples_between(1, Fraction(5, 4), 1000), 250)
+    assert_equal(util.samples_between(Fraction(1, 3), Fraction(1, 2), 1000),
+                 util.to_samp_or_sec(Fraction(1, 2) - Fraction(1, 3), 1000))
+    assert_equal(util.samples_between(0.5, 0.75, 1000), 250)
+    assert_equal(util.samples_between(0.5, 0.75, None), 0.25)
 
 
 def test_event_offset():
@@ -58,6 +133,8 @@ def test_event_offset():
     assert_array_equal(util.event_offset(asarray(data), 2), [3, 4, 5])
     marked = rec.fromarrays((data, ['a', 'b', 'c']), names=('start', 'names'))
     assert_array_equal(util.event_offset(marked, 1)['start'], [2, 3, 4])
+    # the argument isn't modified
+    assert_array_equal(marked['start'], [1, 2, 3])
 
 
 def test_any_predicate():
@@ -68,5 +145,16 @@ def test_any_predicate():
     assert_true(util.any_predicate(lambda y: y == 1, lambda y: y == 2)(x))
     assert_false(util.any_predicate(lambda y: y == 2)(x))
 
+
+def test_read_array():
+    from numpy import arange
+    import h5py
+    data = arange(100)
+    assert_true(util.read_array(data) is data)
+    fp = h5py.File("read_array", driver="core", backing_store=False)
+    assert_array_equal(util.read_array(fp.create_dataset("data", data=data)), data)
+    empty = util.read_array(fp.create_dataset("empty", shape=(0,), dtype='i'))
+    assert_equal(empty.size, 0)
+
 # Variables:
 # End: